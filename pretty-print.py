@@ -1,16 +1,67 @@
+import functools
 import gdb.printing
-import re
+import struct
+
+_INT_UNPACK_CODES = { 1: 'b', 2: 'h', 4: 'i', 8: 'q' }
+_FLT_UNPACK_CODES = { 4: 'f', 8: 'd' }
+
+def _unpack_format(type):
+    if type.code == gdb.TYPE_CODE_FLT:
+        code = _FLT_UNPACK_CODES.get(type.sizeof)
+    elif type.code == gdb.TYPE_CODE_INT:
+        code = _INT_UNPACK_CODES.get(type.sizeof)
+        if code is not None and int(gdb.Value(-1).cast(type)) > 0:
+            code = code.upper()
+    elif type.code == gdb.TYPE_CODE_PTR:
+        code = _INT_UNPACK_CODES.get(type.sizeof)
+        if code is not None:
+            code = code.upper()
+    else:
+        return None
+
+    if code is None:
+        return None
+
+    # the kernel targets i386, so inferior memory is little-endian
+    return '<' + code
+
+_IDX_KEYS = tuple('[%d]' % i for i in range(1024))
+_TUPLE_KEYS = tuple('<%d>' % i for i in range(16))
+
+def _idx_key(idx):
+    if idx < len(_IDX_KEYS):
+        return _IDX_KEYS[idx]
+    return '[%d]' % idx
+
+def _tuple_key(idx):
+    if idx < len(_TUPLE_KEYS):
+        return _TUPLE_KEYS[idx]
+    return '<%d>' % idx
+
+# smaller containers hand gdb a ready-made list instead of a generator
+_EAGER_CHILDREN = 1024
+
+def _collect(children, size):
+    if size < _EAGER_CHILDREN:
+        return list(children)
+    return children
+
+def _children_limit():
+    # gdb reports an unlimited 'print elements' as None (0 on older versions)
+    return gdb.parameter('print elements') or None
 
 def create_iter(item, end, idx):
     return vectorPrinter._iterator(item, end, idx)
 
 class vectorPrinter:
     class _iterator:
-        def __init__(self, item, end, idx):
-            self.item = item
-            self.end = end
-            self.size = self.end - self.item
+        def __init__(self, item, end, idx, limit=None):
+            self.ptr_type = item.type
+            self.esize = item.type.target().sizeof
+            self.item = int(item)
+            self.end = int(end)
             self.idx = idx
+            self.limit = limit
 
         def __iter__(self):
             return self
@@ -18,9 +69,13 @@ class vectorPrinter:
         def __next__(self):
             if self.item >= self.end:
                 raise StopIteration
-            key = '[%d]' % self.idx
-            iter = self.item.dereference()
-            self.item += 1
+            if self.idx == self.limit:
+                more = (self.end - self.item) // self.esize
+                self.item = self.end
+                return '...', '<%d more>' % more
+            key = _idx_key(self.idx)
+            iter = gdb.Value(self.item).cast(self.ptr_type).dereference()
+            self.item += self.esize
             self.idx += 1
             return key, iter
 
@@ -34,108 +89,158 @@ class vectorPrinter:
         return 'array'
 
     def children(self):
-        if self.val['m_size'] == 0:
+        size = int(self.val['m_size'])
+        if size == 0:
             return [ ('<vector of size 0>', '') ]
-        return self._iterator(self.val['m_data'], self.val['m_data'] + self.val['m_size'], 0)
+        data = self.val['m_data']
 
-def _leftmost(node):
-    ret = node
-    while ret['left'] != 0:
-        ret = ret['left'].dereference()
-    return ret
+        limit = _children_limit()
+        count = size if limit is None else min(size, limit)
 
-def _next(node):
-    if node['right']:
-        return _leftmost(node['right'].dereference())
-    else:
-        if node['parent'] == 0:
-            return None
-        parent = node['parent'].dereference()
-        if parent['left'] == node.address:
-            return parent
-        ret = node
-        while True:
-            ret = ret['parent'].dereference()
-            if ret['parent'] == 0:
-                return None
-            if ret['parent'].dereference()['left'] == ret.address:
-                break
-        return ret['parent'].dereference()
+        # only scalars are rebuilt from raw bytes: other elements must stay
+        # lvalues so that nested printers can still take their address
+        elem_type = data.type.target()
+        fmt = _unpack_format(elem_type.strip_typedefs())
+        if fmt is None:
+            return _collect(self._iterator(data, data + size, 0, limit), size)
+
+        try:
+            buf = gdb.selected_inferior().read_memory(int(data), count * elem_type.sizeof)
+        except gdb.MemoryError:
+            return _collect(self._iterator(data, data + size, 0, limit), size)
+
+        items = (gdb.Value(item).cast(elem_type) for (item,) in struct.iter_unpack(fmt, buf))
+        return _collect(self._buffered(items, size, count), size)
+
+    @staticmethod
+    def _buffered(items, size, count):
+        for idx, item in enumerate(items):
+            yield _idx_key(idx), item
+        if count < size:
+            yield '...', '<%d more>' % (size - count)
+
+def _leftmost(nodeptr, stack):
+    while int(nodeptr) != 0:
+        node = nodeptr.dereference()
+        stack.append(node)
+        nodeptr = node['left']
 
 class rbtreePrinter:
     def __init__(self, type, val):
         self.type = type
         self.val = val['tree']
+        self.root = self.val['root']
+        self.size = int(self.val['_size'])
 
     def to_string(self):
-        return "%s of size %d" % (self.type, self.val['_size'])
+        return "%s of size %d" % (self.type, self.size)
 
     def display_hint(self):
         return 'array'
 
     def children(self):
-        yield 'root', self.val['root']
-        if self.val['root'] == 0:
+        if self.size == 0:
+            return [ ('<%s of size 0>' % self.type, '') ]
+        return _collect(self._children(), self.size)
+
+    def _children(self):
+        yield 'root', self.root
+        if int(self.root) == 0:
             return
 
-        yield 'size', self.val['_size']
+        yield 'size', self.size
 
-        nd = _leftmost(self.val['root'].dereference())
+        limit = _children_limit()
+        stack = []
+        _leftmost(self.root, stack)
         i = 0
-        while True:
-            yield "[%d]" % i, nd['value']
-            nd = _next(nd)
+        while stack:
+            if i == limit:
+                yield '...', '<%d more>' % (self.size - i)
+                return
+            node = stack.pop()
+            yield _idx_key(i), node['value']
             i += 1
-            if nd == None:
-                break
+            _leftmost(node['right'], stack)
 
 class stringPrinter:
     def __init__(self, val):
         self.val = val
     
     def to_string(self):
-        return self.val['m_data']
+        data = self.val['m_data']
+        if int(data) == 0:
+            return data
+        # m_size counts the terminating NUL
+        return data.lazy_string(length=int(self.val['m_size']) - 1)
     
     def children(self):
-        yield 'str', self.val['m_data']
+        data = self.val['m_data']
+        yield 'str', data
 
-        if self.val['m_data'] == 0:
+        if int(data) == 0:
             return
 
         yield 'length', self.val['m_size'] - 1
 
-        ptr = self.val['m_data']
-        i = 0
+        # latin-1 maps every byte to exactly one character
+        char_type = data.type.target()
+        chars = data.string('iso-8859-1')
 
-        while ptr.dereference() != 0:
-            yield '[%d]' % i, ptr.dereference()
-            ptr += 1
-            i += 1
+        for i, ch in enumerate(chars):
+            yield _idx_key(i), gdb.Value(ord(ch)).cast(char_type)
+
+        yield _idx_key(len(chars)), 0
+
+def _container_tag(val):
+    # build_pretty_printer also hands over pointers and references
+    type = val.type.strip_typedefs()
+    if type.code in (gdb.TYPE_CODE_PTR, gdb.TYPE_CODE_REF):
+        type = type.target()
+    return type.unqualified().strip_typedefs().tag
 
-        yield '[%d]' % i, 0
+@functools.lru_cache(maxsize=512)
+def _node_ptr_type(tag):
+    return gdb.lookup_type(tag + '::node').pointer()
+
+@functools.lru_cache(maxsize=None)
+def _list_node_ptr_from_iter_tag(tag):
+    return _node_ptr_type(tag.rsplit('::_iterator<', 1)[0])
+
+@functools.lru_cache(maxsize=None)
+def _void_ptr_type():
+    return gdb.lookup_type('void').pointer()
 
 class listPrinter:
     def __init__(self, val):
         self.val = val
+        self.value_node_type = _node_ptr_type(_container_tag(val))
+        self.size = int(val['m_size'])
     
     def to_string(self):
-        return "std::list of size %d" % self.val['m_size']
+        return "std::list of size %d" % self.size
 
     def display_hint(self):
         return 'array'
 
     def children(self):
+        return _collect(self._children(), self.size)
+
+    def _children(self):
         head = self.val['m_head']
 
         yield 'head', head.address
 
+        limit = _children_limit()
+        head_addr = int(head.address)
         node = head['next']
         idx = 0
-        while node != head.address:
-            nodeval = node.reinterpret_cast(
-                gdb.lookup_type(self.val.type.unqualified().strip_typedefs().tag + '::node').pointer()
-                )
-            yield '[%d]' % idx, nodeval['value']
+        while int(node) != head_addr:
+            if idx == limit:
+                yield '...', '<%d more>' % (self.size - idx)
+                return
+            nodeval = node.reinterpret_cast(self.value_node_type)
+            yield _idx_key(idx), nodeval['value']
             idx += 1
             node = node['next']
 
@@ -145,13 +250,12 @@ class listIteratorPrinter:
     
     def children(self):
         yield 'addr', self.val['p']
-        if self.val['p'] == 0:
+        if int(self.val['p']) == 0:
             return
         
         nodeptr = self.val['p']
-        iter_type = self.val.type.unqualified().strip_typedefs().tag
-        iter_type = iter_type[:iter_type.rfind('::')]
-        nodeptr = nodeptr.cast(gdb.lookup_type(iter_type + '::node').pointer())
+        iter_tag = _container_tag(self.val)
+        nodeptr = nodeptr.cast(_list_node_ptr_from_iter_tag(iter_tag))
         
         yield 'value', nodeptr['value']
 
@@ -161,7 +265,7 @@ class rbtreeIteratorPrinter:
     
     def children(self):
         yield 'addr', self.val['p']
-        if self.val['p'] == 0:
+        if int(self.val['p']) == 0:
             return
         
         yield 'value', self.val['p']['value']
@@ -181,21 +285,45 @@ class pairPrinter:
         yield 'first', self.val['first']
         yield 'second', self.val['second']
 
+_FIELD_NAMES = {}
+
+def _field_names(type):
+    key = str(type)
+    names = _FIELD_NAMES.get(key)
+    if names is None:
+        names = { field.name for field in type.strip_typedefs().fields() }
+        _FIELD_NAMES[key] = names
+    return names
+
 class tuplePrinter:
     def __init__(self, val):
         self.val = val
     
     def children(self):
+        cur = self.val
+
+        # build_pretty_printer also hands over pointers and references
+        if cur.type.strip_typedefs().code in (gdb.TYPE_CODE_PTR, gdb.TYPE_CODE_REF):
+            cur = cur.referenced_value()
+
+        # std::tuple keeps its elements in its tuple_impl base class
+        for field in cur.type.strip_typedefs().fields():
+            if field.is_base_class:
+                cur = cur[field]
+                break
+
         i = 0
-        try:
-            cur = self.val
-            while True:
-                yield '<%d>' % i, cur['val']
-                i += 1
-                cur = cur['next']
-        except Exception:
-            if i == 0:
-                yield 'tuple of size 0', ''
+        names = _field_names(cur.type)
+        while 'val' in names:
+            yield _tuple_key(i), cur['val']
+            i += 1
+            if 'next' not in names:
+                break
+            cur = cur['next']
+            names = _field_names(cur.type)
+
+        if i == 0:
+            yield 'tuple of size 0', ''
 
 class functionPrinter:
     def __init__(self, val):
@@ -205,7 +333,6 @@ class functionPrinter:
         return self.val.type.tag
     
     def children(self):
-        print(self.val['_data'].type)
         yield 'function data', self.val['_data']
 
 class referenceWrapperPrinter:
@@ -213,12 +340,80 @@ class referenceWrapperPrinter:
         self.val = val
     
     def to_string(self):
-        return "std::reference_wrapper to %x" % self.val['_ptr']
+        return "std::reference_wrapper to %x" % int(self.val['_ptr'])
     
     def children(self):
-        yield 'addr', self.val['_ptr'].cast(gdb.lookup_type('void').pointer())
+        yield 'addr', self.val['_ptr'].cast(_void_ptr_type())
         yield 'reference', self.val['_ptr']
 
+_PRINTERS = {
+    'std::pair': pairPrinter,
+    'std::tuple': tuplePrinter,
+    'std::function': functionPrinter,
+    'std::reference_wrapper': referenceWrapperPrinter,
+    'std::list': listPrinter,
+    'std::vector': vectorPrinter,
+    'std::map': functools.partial(rbtreePrinter, "std::map"),
+    'std::set': functools.partial(rbtreePrinter, "std::set"),
+    'types::string': stringPrinter,
+}
+
+_ITERATOR_PRINTERS = {
+    'std::list': listIteratorPrinter,
+    'std::vector': vectorIteratorPrinter,
+    'std::impl::rbtree': rbtreeIteratorPrinter,
+}
+
+def _is_iterator(typename):
+    # only an _iterator nested directly in the outermost template counts,
+    # not one that appears inside its template arguments
+    idx = typename.find('>::_iterator<')
+    while idx != -1:
+        outer = typename[:idx + 1]
+        if outer.count('<') == outer.count('>'):
+            return True
+        idx = typename.find('>::_iterator<', idx + 1)
+    return False
+
+# scalars can never match a printer, typedefs still need stripping
+_AGGREGATE_CODES = (gdb.TYPE_CODE_STRUCT, gdb.TYPE_CODE_UNION, gdb.TYPE_CODE_TYPEDEF)
+
+# every printed container lives in one of these namespaces
+_PREFIXES = ('std::', 'types::')
+
+def _resolve(type):
+    typename = type.unqualified().strip_typedefs().tag
+
+    if typename == None or not typename.startswith(_PREFIXES):
+        return None
+    if not typename.endswith('>'):
+        return None
+
+    head = typename.split('<', 1)[0]
+    is_iterator = _is_iterator(typename)
+
+    if head == 'std::list':
+        tag = typename
+        if is_iterator:
+            tag = typename.rsplit('::_iterator<', 1)[0]
+
+        # binaries built without the node type can never use the list
+        # printers, so the failure is cached along with the type
+        try:
+            _node_ptr_type(tag)
+        except gdb.error:
+            return None
+
+    if is_iterator:
+        return _ITERATOR_PRINTERS.get(head)
+
+    return _PRINTERS.get(head)
+
+# printer constructor (or None) per type name; _MISS marks names that have
+# not been resolved yet
+_MISS = object()
+_TYPE_TO_FACTORY = {}
+
 def build_pretty_printer(val):
     type = val.type
 
@@ -226,52 +421,53 @@ def build_pretty_printer(val):
         type = type.target()
     if type.code == gdb.TYPE_CODE_PTR:
         type = type.target()
-    
-    type = type.unqualified().strip_typedefs()
-    typename = type.tag
 
-    if typename == None:
+    if type.code not in _AGGREGATE_CODES:
         return None
-    
-    if re.compile(r"^std::pair<.*, .*>$").match(typename):
-        return pairPrinter(val)
-    
-    if re.compile(r"^std::tuple<.*>$").match(typename):
-        return tuplePrinter(val)
-
-    if re.compile(r"^std::function<.*>$").match(typename):
-        return functionPrinter(val)
-    
-    if re.compile(r"^std::reference_wrapper<.*>$").match(typename):
-        return referenceWrapperPrinter(val)
 
-    # if re.compile(r"^std::list<.*, .*>::node$").match(typename):
-    #     return None
-    
-    if re.compile(r"^std::list<.*, .*>::_iterator<.*?>$").match(typename):
-        return listIteratorPrinter(val)
+    # function-local typedefs carry bare names that may collide, so only
+    # structs and unions are keyed by the name they were written with
+    if type.code == gdb.TYPE_CODE_TYPEDEF:
+        type = type.strip_typedefs()
 
-    if re.compile(r"^std::vector<.*, .*>::_iterator<.*?>$").match(typename):
-        return vectorIteratorPrinter(val)
+    key = str(type)
+    ctor = _TYPE_TO_FACTORY.get(key, _MISS)
+    if ctor is _MISS:
+        ctor = _resolve(type)
+        _TYPE_TO_FACTORY[key] = ctor
 
-    if re.compile(r"^std::list<.*, .*>$").match(typename):
-        return listPrinter(val)
-
-    if re.compile(r"^std::vector<.*, .*>$").match(typename):
-        return vectorPrinter(val)
-
-    if re.compile(r"^std::map<.*, .*, .*, .*>$").match(typename):
-        return rbtreePrinter("std::map", val)
-
-    if re.compile(r"^std::set<.*, .*, .*>$").match(typename):
-        return rbtreePrinter("std::set", val)
-
-    if re.compile(r"^std::impl::rbtree<.*, .*, .*>::_iterator<.*?>$").match(typename):
-        return rbtreeIteratorPrinter(val)
+    if ctor is None:
+        return None
 
-    if re.compile(r"^types::string<.*>$").match(typename):
-        return stringPrinter(val)
-    
-    return None
+    try:
+        return ctor(val)
+    except gdb.error:
+        # unreadable or optimized-out values fall back to raw printing; the
+        # type itself was already vetted by _resolve
+        return None
 
+# a reloaded kernel brings new types and layouts, so nothing resolved
+# against the previous objfile may be reused
+def _clear_type_caches(event):
+    _node_ptr_type.cache_clear()
+    _list_node_ptr_from_iter_tag.cache_clear()
+    _void_ptr_type.cache_clear()
+    _TYPE_TO_FACTORY.clear()
+    _FIELD_NAMES.clear()
+
+# sourcing this file again must replace, not stack, both the dispatcher and
+# its objfile hook; the marker carries the hook and keeps unrelated printers
+# that share the function name in place
+for printer in gdb.pretty_printers:
+    handler = getattr(printer, 'gbos_dispatcher', None)
+    if callable(handler):
+        gdb.events.new_objfile.disconnect(handler)
+
+gdb.pretty_printers[:] = [
+    printer for printer in gdb.pretty_printers
+    if not hasattr(printer, 'gbos_dispatcher')
+]
+
+build_pretty_printer.gbos_dispatcher = _clear_type_caches
+gdb.events.new_objfile.connect(_clear_type_caches)
 gdb.pretty_printers.append(build_pretty_printer)